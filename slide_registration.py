@@ -9,6 +9,8 @@ to a ``registration_results`` directory within the specified output path.
 
 Usage:
     python slide_registration.py --cd8_slide <cd8_path> --he_slide <he_path> --output_dir <output_path>
+    python slide_registration.py --wasabi_json <json> --pair_indices 1,3,5-8 --output_dir <output_path>
+    python slide_registration.py --wasabi_json <json> --workers 4 --output_dir <output_path>
 
 Requirements:
     - VALIS 1.1.0
@@ -22,40 +24,76 @@ import os
 import sys
 import time
 import argparse
+import multiprocessing as mp
 from datetime import date
-from valis import registration
-from slide_utils import load_wasabi_tree, get_slide_pairs
+from valis import registration, slide_io
+from slide_utils import load_slide_pairs
 
 DATE_STR = date.today().isoformat()
 
-def main():
-    parser = argparse.ArgumentParser(description="Perform slide registration with VALIS")
-    parser.add_argument("--cd8_slide", help="Path to CD8 slide")
-    parser.add_argument("--he_slide", help="Path to H&E slide")
-    parser.add_argument("--wasabi_json", help="Path to wasabi_file_tree.json for automatic selection")
-    parser.add_argument("--pair_index", type=int, help="Index of slide pair to use (1-based)")
-    parser.add_argument("--output_dir", required=True, help="Path to output directory")
-    args = parser.parse_args()
+# VALIS slide readers selectable with --slide_reader ("auto" lets VALIS choose)
+SLIDE_READERS = {
+    "vips": slide_io.VipsSlideReader,
+    "bioformats": slide_io.BioFormatsSlideReader,
+}
+
+def parse_pair_indices(spec):
+    """Parse a 1-based index list such as ``"1,3,5-8"`` into a list of ints.
+
+    Used as an argparse ``type``, so malformed specs become usage errors.
+    """
+    indices = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        start, sep, end = part.partition("-")
+        if not start.strip().isdigit() or (sep and not end.strip().isdigit()):
+            raise argparse.ArgumentTypeError(f"invalid pair index or range: '{part}'")
+        start = int(start)
+        end = int(end) if sep else start
+        if start > end:
+            raise argparse.ArgumentTypeError(f"range start is greater than its end: '{part}'")
+        indices.extend(range(start, end + 1))
+    if not indices:
+        raise argparse.ArgumentTypeError("no pair indices given")
+    return indices
+
+def warp_and_save_pair(registrar, cd8_slide, he_slide, results_dir,
+                       he_compression="jpeg", cd8_compression="zstd", quality=90):
+    """Warp and save both slides as compressed, tiled pyramidal OME-TIFFs.
+
+    VALIS chooses the tile size from the slide reader. Each slide gets its own codec: lossy JPEG suits the RGB H&E slide, while the
+    CD8 immunofluorescence channel uses lossless zstd to avoid 8-bit lossy
+    artifacts. Output names match ``Valis.warp_and_save_slides``.
+    """
+    for src_f, compression in ((cd8_slide, cd8_compression), (he_slide, he_compression)):
+        slide_obj = registrar.get_slide(src_f)
+        dst_f = os.path.join(results_dir, slide_obj.name + ".ome.tiff")
+        slide_obj.warp_and_save_slide(dst_f, crop="overlap", pyramid=True,
+                                      compression=compression, Q=quality)
+
+def run_pair(registrar, cd8_slide, he_slide, results_dir, he_compression="jpeg",
+             cd8_compression="zstd", quality=90, reader_cls=None):
+    """Register the pair held by ``registrar`` and save the warped slides.
+
+    ``reader_cls`` pins the VALIS slide reader; by default VALIS picks one per slide.
+    """
+    # Perform registration
+    registrar.register(reader_cls=reader_cls)
 
-    output_dir = args.output_dir
+    # Warp and save the registered slides to the output directory
+    print(f"Warping and saving aligned slides to: {results_dir}")
+    warp_and_save_pair(registrar, cd8_slide, he_slide, results_dir,
+                       he_compression, cd8_compression, quality)
 
-    # Determine slide paths either from arguments or the wasabi JSON file
-    if args.wasabi_json and args.pair_index is not None:
-        tree = load_wasabi_tree(args.wasabi_json)
-        pairs = get_slide_pairs(tree)
-        if args.pair_index < 1 or args.pair_index > len(pairs):
-            print(f"Error: pair_index {args.pair_index} out of range. Found {len(pairs)} pairs.")
-            sys.exit(1)
-        selected = pairs[args.pair_index - 1]
-        cd8_slide = selected["cd8_slide"]
-        he_slide = selected["he_slide"]
-        print(f"Selected pair {selected['pair_name']}\n  CD8: {cd8_slide}\n  HE: {he_slide}")
-    elif args.cd8_slide and args.he_slide:
-        cd8_slide = args.cd8_slide
-        he_slide = args.he_slide
-    else:
-        parser.error("Provide --cd8_slide and --he_slide or --wasabi_json with --pair_index")
+def register_pair(cd8_slide, he_slide, output_dir, he_compression="jpeg",
+                  cd8_compression="zstd", quality=90, valis_kwargs=None, reader_cls=None):
+    """Register one CD8/H&E pair and save the warped slides under ``output_dir``.
 
+    The JVM is left running so that further pairs can reuse it; call
+    ``registration.kill_jvm()`` once all pairs are done.
+    """
     # Prepare subdirectories for results and evaluation
     results_dir = os.path.join(output_dir, "registration_results")
     eval_dir = os.path.join(output_dir, "registration_evaluation")
@@ -66,13 +104,10 @@ def main():
     # Validate paths
     if not os.path.exists(cd8_slide):
         print(f"Error: CD8 slide not found at {cd8_slide}")
-        sys.exit(1)
+        return 1
     if not os.path.exists(he_slide):
         print(f"Error: H&E slide not found at {he_slide}")
-        sys.exit(1)
-    if not os.path.exists(output_dir):
-        print(f"Creating output directory: {output_dir}")
-        os.makedirs(output_dir, exist_ok=True)
+        return 1
 
     print("Starting registration process...")
     start_time = time.time()
@@ -83,30 +118,134 @@ def main():
     # Initialize VALIS
     # Initialize VALIS with the CD8 slide explicitly set as the reference image.
     # Using the slide directory for ``src_dir`` helps VALIS locate the images
-    # when absolute paths are provided.
+    # when absolute paths are provided. A Valis object fixes its image list,
+    # name and output folders at construction, so one is created per pair;
+    # the JVM is what gets shared across pairs.
     registrar = registration.Valis(
         src_dir=os.path.dirname(cd8_slide),  # Directory containing the slides
         dst_dir=output_dir,                  # Destination directory
-        img_list=slide_paths
+        img_list=slide_paths,
+        **(valis_kwargs or {})
     )
 
-    # Perform registration
-    registrar.register()
-
-    # Warp and save the registered slides to the output directory
-    print(f"Warping and saving aligned slides to: {results_dir}")
-    registrar.warp_and_save_slides(results_dir, crop="overlap")
-
-    # Clean up the JVM as recommended
-    print("Cleaning up resources...")
-    registration.kill_jvm()
+    run_pair(registrar, cd8_slide, he_slide, results_dir,
+             he_compression, cd8_compression, quality, reader_cls)
 
     elapsed_time = time.time() - start_time
     print(f"Registration completed in {elapsed_time:.2f} seconds")
     print(f"Results saved to: {results_dir}")
+    return 0
+
+def _register_pair_job(job):
+    """Register one pair, reporting any error instead of stopping the batch.
+
+    Used both as the pool worker entry point and by the sequential loop.
+    """
+    cd8_slide, he_slide, output_dir, *options = job
+    try:
+        return register_pair(cd8_slide, he_slide, output_dir, *options)
+    except Exception as e:
+        print(f"Error registering {cd8_slide} / {he_slide}: {e}")
+        return 1
+
+def main():
+    parser = argparse.ArgumentParser(description="Perform slide registration with VALIS")
+    parser.add_argument("--cd8_slide", help="Path to CD8 slide")
+    parser.add_argument("--he_slide", help="Path to H&E slide")
+    parser.add_argument("--wasabi_json", help="Path to wasabi_file_tree.json for automatic selection")
+    parser.add_argument("--pair_index", type=int, help="Index of slide pair to use (1-based)")
+    parser.add_argument("--pair_indices", type=parse_pair_indices,
+                        help="Comma-separated 1-based pair indices or ranges (e.g. 1,3,5-8) to register "
+                             "in one run; each pair is written to <output_dir>/<pair_name>")
+    parser.add_argument("--output_dir", required=True, help="Path to output directory")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of pairs registered in parallel, each in its own process and JVM (default: 1)")
+    parser.add_argument("--slide_reader", choices=["auto"] + sorted(SLIDE_READERS), default="auto",
+                        help="Slide reader used by VALIS; 'vips' pins the libvips backend (default: auto)")
+    parser.add_argument("--max_image_dim_px", type=int,
+                        help="Maximum dimension of the images VALIS works with during registration")
+    parser.add_argument("--max_processed_image_dim_px", type=int,
+                        help="Maximum dimension of the processed images used for feature detection "
+                             "(defaults to --max_image_dim_px when only that is given)")
+    parser.add_argument("--he_compression", default="jpeg",
+                        help="Compression for the warped H&E slide (default: jpeg)")
+    parser.add_argument("--cd8_compression", default="zstd",
+                        help="Compression for the warped CD8 slide (default: zstd)")
+    parser.add_argument("--jpeg_quality", type=int, default=90,
+                        help="Quality used for JPEG compression (default: 90)")
+    args = parser.parse_args()
+
+    output_dir = args.output_dir
+
+    # Determine (cd8_slide, he_slide, output_dir) jobs either from arguments or the wasabi JSON file.
+    # Without --pair_index/--pair_indices every pair in the JSON is registered.
+    explicit_slides = args.cd8_slide and args.he_slide
+    if args.wasabi_json and (args.pair_index is not None or args.pair_indices or not explicit_slides):
+        pairs = load_slide_pairs(args.wasabi_json)
+        batch = bool(args.pair_indices) or args.pair_index is None
+        if args.pair_indices:
+            indices = args.pair_indices
+        elif args.pair_index is not None:
+            indices = [args.pair_index]
+        else:
+            indices = list(range(1, len(pairs) + 1))
+        for idx in indices:
+            if idx < 1 or idx > len(pairs):
+                print(f"Error: pair_index {idx} out of range. Found {len(pairs)} pairs.")
+                sys.exit(1)
+
+        jobs = []
+        for idx in indices:
+            selected = pairs[idx - 1]
+            cd8_slide = selected["cd8_slide"]
+            he_slide = selected["he_slide"]
+            print(f"Selected pair {selected['pair_name']}\n  CD8: {cd8_slide}\n  HE: {he_slide}")
+            # A single pair keeps the original layout directly under output_dir
+            pair_output_dir = os.path.join(output_dir, selected["pair_name"]) if batch else output_dir
+            jobs.append((cd8_slide, he_slide, pair_output_dir))
+    elif explicit_slides:
+        jobs = [(args.cd8_slide, args.he_slide, output_dir)]
+    else:
+        parser.error("Provide --cd8_slide and --he_slide or --wasabi_json")
+
+    if not os.path.exists(output_dir):
+        print(f"Creating output directory: {output_dir}")
+        os.makedirs(output_dir, exist_ok=True)
+
+    # The slide reader is an argument of Valis.register(), not of the constructor
+    reader_cls = SLIDE_READERS.get(args.slide_reader)
+
+    # Image size options passed to every Valis object
+    valis_kwargs = {}
+    if args.max_image_dim_px is not None:
+        valis_kwargs["max_image_dim_px"] = args.max_image_dim_px
+    max_processed = args.max_processed_image_dim_px or args.max_image_dim_px
+    if max_processed is not None:
+        if args.max_image_dim_px is not None:
+            # Processed images cannot be larger than the images they come from
+            max_processed = min(max_processed, args.max_image_dim_px)
+        valis_kwargs["max_processed_image_dim_px"] = max_processed
+
+    options = (args.he_compression, args.cd8_compression, args.jpeg_quality, valis_kwargs, reader_cls)
+    workers = max(1, min(args.workers, len(jobs)))
+    failures = 0
+    if workers > 1:
+        # The JVM is not fork-safe, so every worker is spawned fresh and starts its own
+        print(f"Registering {len(jobs)} pairs with {workers} worker processes")
+        with mp.get_context("spawn").Pool(workers) as pool:
+            failures = sum(pool.map(_register_pair_job, [job + options for job in jobs], chunksize=1))
+    else:
+        # All pairs share one JVM, which is only started and torn down once
+        try:
+            for job in jobs:
+                failures += _register_pair_job(job + options)
+        finally:
+            # Clean up the JVM as recommended
+            print("Cleaning up resources...")
+            registration.kill_jvm()
 
     # Return success status for shell script
-    return 0
+    return 1 if failures else 0
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -1,37 +1,79 @@
 import json
+import os
+from collections import deque
 from typing import List, Dict
 
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
 
 def load_wasabi_tree(json_path: str) -> Dict:
     """Load the JSON file describing the wasabi file tree."""
-    with open(json_path, "r") as f:
-        return json.load(f)
-
-
-def _collect_pairs(node: Dict, prefix: List[str], pairs: List[Dict]):
-    if node.get("type") == "directory" and "Pair" in node.get("name", ""):
-        pair_info = {
-            "pair_name": node["name"],
-            "he_slide": None,
-            "cd8_slide": None,
-        }
-        for child in node.get("children", []):
-            if child.get("type") == "file":
-                name_lower = child["name"].lower()
-                path = "/".join(prefix + [node["name"], child["name"]])
-                if "unmixed if" in name_lower:
-                    pair_info["cd8_slide"] = path
-                elif "he" in name_lower:
-                    pair_info["he_slide"] = path
-        if pair_info["he_slide"] and pair_info["cd8_slide"]:
-            pairs.append(pair_info)
-    for child in node.get("children", []):
-        if child.get("type") == "directory":
-            _collect_pairs(child, prefix + [node["name"]], pairs)
+    with open(json_path, "rb") as f:
+        return _loads(f.read())
+
+
+def _collect_pairs(tree: Dict) -> List[Dict]:
+    """Walk the tree depth-first (pre-order) and collect complete slide pairs."""
+    pairs: List[Dict] = []
+    stack = deque([(tree, ())])
+    while stack:
+        node, prefix = stack.pop()
+        children = node.get("children") or ()
+        if node.get("type") == "directory" and "Pair" in node.get("name", ""):
+            pair_info = {
+                "pair_name": node["name"],
+                "he_slide": None,
+                "cd8_slide": None,
+            }
+            for child in children:
+                if child.get("type") == "file":
+                    name_lower = child["name"].lower()
+                    path = "/".join((*prefix, node["name"], child["name"]))
+                    if "unmixed if" in name_lower:
+                        pair_info["cd8_slide"] = path
+                    elif "he" in name_lower:
+                        pair_info["he_slide"] = path
+            if pair_info["he_slide"] and pair_info["cd8_slide"]:
+                pairs.append(pair_info)
+        # Push in reverse so children are visited in their original order
+        child_prefix = prefix + (node["name"],)
+        for child in reversed(children):
+            if child.get("type") == "directory":
+                stack.append((child, child_prefix))
+    return pairs
 
 
 def get_slide_pairs(tree: Dict) -> List[Dict]:
     """Return a list of dictionaries containing HE and CD8 slide paths."""
-    pairs: List[Dict] = []
-    _collect_pairs(tree, [], pairs)
+    return _collect_pairs(tree)
+
+
+def load_slide_pairs(json_path: str) -> List[Dict]:
+    """Return the slide pairs for a wasabi tree JSON, using a sidecar cache.
+
+    The flat pair list is stored next to the JSON in ``<json_path>.pairs.cache``
+    together with the JSON's modification time, so the tree only has to be
+    parsed and walked again after the JSON changes.
+    """
+    mtime = os.path.getmtime(json_path)
+    cache_path = json_path + ".pairs.cache"
+    try:
+        with open(cache_path, "rb") as f:
+            cached = _loads(f.read())
+        if cached.get("mtime") == mtime:
+            return cached["pairs"]
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+
+    pairs = get_slide_pairs(load_wasabi_tree(json_path))
+    try:
+        with open(cache_path, "w") as f:
+            json.dump({"mtime": mtime, "pairs": pairs}, f)
+    except OSError:
+        # A read-only location only costs us the cache
+        pass
     return pairs
@@ -0,0 +1,104 @@
+"""
+Fused SSIM kernel
+=================
+
+Numba implementation of the structural similarity index with the same
+defaults as ``skimage.metrics.structural_similarity`` (7x7 uniform window,
+K1=0.01, K2=0.03, sample covariance, mean over the window-valid region).
+
+Local means, variances and the covariance are computed with running box sums
+in a single pass per output row, so no full-size filtered temporaries are
+allocated. If numba is not installed, scikit-image is used instead.
+"""
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = range
+
+
+def _ssim_mean(x, y, c1, c2, win):
+    """Return the mean SSIM over all windows that fit inside the images."""
+    h, w = x.shape
+    n = win * win
+    cov_norm = n / (n - 1.0)
+    out_h = h - win + 1
+    out_w = w - win + 1
+    row_means = np.zeros(out_h)
+
+    for i in prange(out_h):
+        # Column sums over the window rows i .. i + win - 1
+        cx = np.zeros(w)
+        cy = np.zeros(w)
+        cxx = np.zeros(w)
+        cyy = np.zeros(w)
+        cxy = np.zeros(w)
+        for r in range(i, i + win):
+            for j in range(w):
+                a = np.float64(x[r, j])
+                b = np.float64(y[r, j])
+                cx[j] += a
+                cy[j] += b
+                cxx[j] += a * a
+                cyy[j] += b * b
+                cxy[j] += a * b
+
+        # Slide the window horizontally with running sums
+        sx = sy = sxx = syy = sxy = 0.0
+        for j in range(win):
+            sx += cx[j]
+            sy += cy[j]
+            sxx += cxx[j]
+            syy += cyy[j]
+            sxy += cxy[j]
+
+        acc = 0.0
+        for j in range(out_w):
+            if j > 0:
+                k_in = j + win - 1
+                k_out = j - 1
+                sx += cx[k_in] - cx[k_out]
+                sy += cy[k_in] - cy[k_out]
+                sxx += cxx[k_in] - cxx[k_out]
+                syy += cyy[k_in] - cyy[k_out]
+                sxy += cxy[k_in] - cxy[k_out]
+            ux = sx / n
+            uy = sy / n
+            vx = cov_norm * (sxx / n - ux * ux)
+            vy = cov_norm * (syy / n - uy * uy)
+            vxy = cov_norm * (sxy / n - ux * uy)
+            acc += ((2 * ux * uy + c1) * (2 * vxy + c2)) / ((ux * ux + uy * uy + c1) * (vx + vy + c2))
+        row_means[i] = acc / out_w
+
+    return row_means.mean()
+
+
+if njit is not None:
+    _ssim_mean = njit(parallel=True, fastmath=True, cache=True)(_ssim_mean)
+
+
+def structural_similarity(im1, im2, data_range, win_size=7):
+    """Compute the mean SSIM between two 2-D images.
+
+    Matches ``skimage.metrics.structural_similarity(im1, im2,
+    data_range=data_range, win_size=win_size)`` for grayscale input.
+    """
+    if njit is None:
+        from skimage.metrics import structural_similarity as ssim
+        return ssim(im1, im2, data_range=data_range, win_size=win_size)
+
+    if im1.shape != im2.shape:
+        raise ValueError("Input images must have the same dimensions.")
+    if im1.ndim != 2:
+        raise ValueError("Only 2-D (grayscale) images are supported.")
+    if min(im1.shape) < win_size:
+        raise ValueError("win_size exceeds image extent.")
+
+    c1 = (0.01 * data_range) ** 2
+    c2 = (0.03 * data_range) ** 2
+    x = np.ascontiguousarray(im1, dtype=np.float32)
+    y = np.ascontiguousarray(im2, dtype=np.float32)
+    return float(_ssim_mean(x, y, float(c1), float(c2), win_size))
@@ -4,14 +4,11 @@
 import os
 import sys
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
-import tifffile
-from skimage.metrics import structural_similarity as ssim
-from skimage.metrics import mean_squared_error
-from skimage import exposure
+import cv2
+from PIL import Image, ImageDraw
 import warnings
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 
 # Suppress warnings
 warnings.filterwarnings("ignore")
@@ -26,13 +23,52 @@ def parse_arguments():
         required=True,
         help="Directory containing registration results",
     )
+    parser.add_argument(
+        "--ssim_downsample",
+        type=int,
+        default=4,
+        help="Downsample factor applied to tiles before computing SSIM (1 disables, default: 4)",
+    )
+    parser.add_argument(
+        "--device",
+        choices=["cpu", "cuda"],
+        default="cpu",
+        help="Device for metric calculation; 'cuda' requires CuPy and cuCIM (default: cpu)",
+    )
     return parser.parse_args()
 
+def _import_pyplot():
+    """Import pyplot lazily with the non-interactive Agg backend.
+
+    matplotlib, tifffile and the SSIM kernel are imported on first use so that
+    ``--help`` and early exits do not pay for them.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
+
 def load_slide(filepath):
-    """Load an OME-TIFF slide and return as numpy array"""
+    """Open an OME-TIFF slide lazily and return an array view of its full-resolution level.
+
+    Uncompressed, contiguous slides are memory-mapped; otherwise a zarr array
+    is returned that only reads and decodes the TIFF tiles/strips overlapping
+    a slice. Either way, extracting a few tiles does not require loading the
+    whole slide into memory.
+    """
+    import tifffile
+    import zarr
+
     try:
         print(f"Loading slide: {filepath}")
-        slide = tifffile.imread(filepath)
+        try:
+            slide = tifffile.memmap(filepath, mode='r')
+        except ValueError:
+            # Compressed or non-contiguous data cannot be memory-mapped
+            tif = tifffile.TiffFile(filepath)
+            # The store reads through the open file handle, so tif must stay open
+            store = tif.series[0].levels[0].aszarr()
+            slide = zarr.open(store, mode='r')
         print(f"  Shape: {slide.shape}")
         return slide
     except Exception as e:
@@ -40,52 +76,90 @@ def load_slide(filepath):
         return None
 
 def extract_tile(slide, x, y, size=512):
-    """Extract a tile from the slide at position (x,y) with given size"""
-    try:
-        # Check if coordinates are valid
-        if x < 0 or y < 0 or x + size > slide.shape[1] or y + size > slide.shape[0]:
-            print(f"Invalid coordinates: ({x}, {y}) with size {size} for slide shape {slide.shape}")
-            return None
-
-        # Extract the tile
-        tile = slide[y:y+size, x:x+size]
-        return tile
-    except Exception as e:
-        print(f"Error extracting tile at ({x}, {y}): {e}")
-        return None
+    """Extract a tile from the slide at position (x,y) with given size, or None if out of bounds
+
+    On a memmap this returns a view; matplotlib callers make it contiguous
+    themselves, so metrics never pay for a copy.
+    """
+    if 0 <= x and 0 <= y and x + size <= slide.shape[1] and y + size <= slide.shape[0]:
+        return slide[y:y+size, x:x+size]
+    return None
+
+def _rescale_uint8(gray):
+    """Stretch a uint8 image to its full 0-255 range with a 256-entry lookup table
+
+    Equivalent to ``skimage.exposure.rescale_intensity`` for uint8 input, but
+    done in a single cv2.LUT pass instead of a float rescale.
+    """
+    lo, hi = int(gray.min()), int(gray.max())
+    if lo == 0 and hi == 255:
+        return gray
+    lut = np.clip((np.arange(256) - lo) * 255 / max(hi - lo, 1), 0, 255).astype(np.uint8)
+    return cv2.LUT(gray, lut)
+
+def to_gray(tile):
+    """Convert a tile to uint8 grayscale (cv2 stays in uint8 and is SIMD-accelerated)
+
+    Single-channel tiles (e.g. CD8) skip the conversion and are only cast if needed.
+    """
+    if tile.ndim == 3 and tile.shape[2] == 1:
+        tile = tile.squeeze(-1)
+    if tile.ndim == 2:
+        return np.ascontiguousarray(tile.astype(np.uint8, copy=False))
+    if tile.shape[2] == 3:
+        return cv2.cvtColor(tile.astype(np.uint8, copy=False), cv2.COLOR_RGB2GRAY)
+    return np.mean(tile, axis=2).astype(np.uint8)
+
+def _prepare_grays(tile1, tile2):
+    """Convert both tiles to contrast-stretched uint8 grayscale"""
+    # Normalize for better comparison
+    gray1 = _rescale_uint8(to_gray(tile1))
+    gray2 = _rescale_uint8(to_gray(tile2))
+    return gray1, gray2
+
+def _downsample_for_ssim(gray1, gray2, ssim_downsample):
+    """Area-downsample both grayscale tiles by ``ssim_downsample`` for SSIM"""
+    if ssim_downsample <= 1:
+        return gray1, gray2
+    ds_size = (gray1.shape[1] // ssim_downsample, gray1.shape[0] // ssim_downsample)
+    return (cv2.resize(gray1, ds_size, interpolation=cv2.INTER_AREA),
+            cv2.resize(gray2, ds_size, interpolation=cv2.INTER_AREA))
+
+def calculate_metrics(tile1, tile2, ssim_downsample=4):
+    """Calculate registration quality metrics between two tiles
+
+    SSIM is computed on tiles area-downsampled by ``ssim_downsample``; MSE and
+    correlation use the full-resolution tiles.
+    """
+    from ssim_numba import structural_similarity as ssim
 
-def calculate_metrics(tile1, tile2):
-    """Calculate registration quality metrics between two tiles"""
     results = {}
 
-    # Convert to grayscale if multi-channel
-    if len(tile1.shape) > 2 and tile1.shape[2] > 1:
-        gray1 = np.mean(tile1, axis=2).astype(np.uint8)
-    else:
-        gray1 = tile1.astype(np.uint8)
-
-    if len(tile2.shape) > 2 and tile2.shape[2] > 1:
-        gray2 = np.mean(tile2, axis=2).astype(np.uint8)
-    else:
-        gray2 = tile2.astype(np.uint8)
-
-    # Normalize for better comparison
-    gray1 = exposure.rescale_intensity(gray1)
-    gray2 = exposure.rescale_intensity(gray2)
+    gray1, gray2 = _prepare_grays(tile1, tile2)
 
     try:
         # Calculate SSIM (higher is better, max 1.0)
-        ssim_value = ssim(gray1, gray2, data_range=gray2.max() - gray2.min())
+        ssim_gray1, ssim_gray2 = _downsample_for_ssim(gray1, gray2, ssim_downsample)
+        ssim_value = ssim(ssim_gray1, ssim_gray2, data_range=gray2.max() - gray2.min())
         results['ssim'] = ssim_value
 
+        # MSE and correlation share one float cast and one set of raw sums,
+        # so no difference or mean-subtracted copies are needed
+        g1 = gray1.ravel().astype(np.float64)
+        g2 = gray2.ravel().astype(np.float64)
+        n = g1.size
+        s1 = g1.sum()
+        s2 = g2.sum()
+        ss1 = np.dot(g1, g1)
+        ss2 = np.dot(g2, g2)
+        dot = np.dot(g1, g2)
+
         # Calculate MSE (lower is better)
-        mse_value = mean_squared_error(gray1, gray2)
+        mse_value = (ss1 - 2 * dot + ss2) / n
         results['mse'] = mse_value
 
         # Calculate normalized cross-correlation (higher is better, max 1.0)
-        norm1 = gray1 - np.mean(gray1)
-        norm2 = gray2 - np.mean(gray2)
-        correlation = np.sum(norm1 * norm2) / (np.sqrt(np.sum(norm1**2)) * np.sqrt(np.sum(norm2**2)))
+        correlation = (dot - s1 * s2 / n) / np.sqrt((ss1 - s1 * s1 / n) * (ss2 - s2 * s2 / n))
         results['correlation'] = correlation
 
         return results
@@ -93,8 +167,115 @@ def calculate_metrics(tile1, tile2):
         print(f"Error calculating metrics: {e}")
         return {'ssim': 0, 'mse': float('inf'), 'correlation': 0}
 
-def visualize_tiles(tile1, tile2, he_name, cd8_name, coords, metrics, output_path=None):
-    """Visualize the side-by-side comparison of tiles with metrics"""
+def calculate_metrics_gpu(tile_pairs, ssim_downsample=4):
+    """Calculate registration quality metrics for several tile pairs on the GPU
+
+    Requires CuPy and cuCIM; raises ImportError if they are not installed.
+    All tiles are evaluated on the device and copied back with a single
+    synchronization at the end.
+    """
+    import cupy as cp
+    from cucim.skimage.metrics import structural_similarity as ssim_gpu
+
+    device_values = []
+    for tile1, tile2 in tile_pairs:
+        gray1, gray2 = _prepare_grays(tile1, tile2)
+        ssim_gray1, ssim_gray2 = _downsample_for_ssim(gray1, gray2, ssim_downsample)
+
+        g1 = cp.asarray(gray1).ravel().astype(cp.float64)
+        g2 = cp.asarray(gray2).ravel().astype(cp.float64)
+        data_range = g2.max() - g2.min()
+        ssim_value = ssim_gpu(cp.asarray(ssim_gray1), cp.asarray(ssim_gray2), data_range=data_range)
+
+        n = g1.size
+        s1 = g1.sum()
+        s2 = g2.sum()
+        ss1 = cp.dot(g1, g1)
+        ss2 = cp.dot(g2, g2)
+        dot = cp.dot(g1, g2)
+        mse_value = (ss1 - 2 * dot + ss2) / n
+        correlation = (dot - s1 * s2 / n) / cp.sqrt((ss1 - s1 * s1 / n) * (ss2 - s2 * s2 / n))
+        device_values.append(cp.stack([cp.asarray(ssim_value, dtype=cp.float64), mse_value, correlation]))
+
+    values = cp.asnumpy(cp.stack(device_values)) if device_values else np.empty((0, 3))
+    return [{'ssim': float(v[0]), 'mse': float(v[1]), 'correlation': float(v[2])} for v in values]
+
+def make_overlay(tile1, tile2):
+    """Create an overlay of the two tiles to show registration accuracy"""
+    if len(tile1.shape) == 3 and tile1.shape[2] == 3 and len(tile2.shape) == 2:
+        # If H&E is RGB and CD8 is grayscale, create a combined image
+        overlay = tile1.copy()
+        # Stretch CD8 to the full uint8 range and use it as the red channel
+        overlay[:,:,0] = cv2.normalize(tile2, None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+    else:
+        # Simple additive blend; grayscale tiles are converted to RGB with cv2
+        tile1_rgb = tile1.astype(np.uint8, copy=False)
+        tile2_rgb = tile2.astype(np.uint8, copy=False)
+        if tile1_rgb.ndim == 2:
+            tile1_rgb = cv2.cvtColor(tile1_rgb, cv2.COLOR_GRAY2RGB)
+        if tile2_rgb.ndim == 2:
+            tile2_rgb = cv2.cvtColor(tile2_rgb, cv2.COLOR_GRAY2RGB)
+
+        # Create a simple overlay, blended directly in uint8
+        overlay = cv2.addWeighted(tile1_rgb, 0.5, tile2_rgb, 0.5, 0)
+    return overlay
+
+def _metrics_text(metrics):
+    """Format the metrics summary shown under each comparison"""
+    return (
+        f"Registration Metrics:\n"
+        f"SSIM: {metrics['ssim']:.4f} (higher is better, max 1.0)\n"
+        f"MSE: {metrics['mse']:.4f} (lower is better)\n"
+        f"Correlation: {metrics['correlation']:.4f} (higher is better, max 1.0)"
+    )
+
+def _to_rgb8(tile):
+    """Return an RGB uint8 version of a tile for direct image writing"""
+    if tile.ndim == 2:
+        if tile.dtype != np.uint8:
+            tile = cv2.normalize(tile, None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+        return cv2.cvtColor(tile, cv2.COLOR_GRAY2RGB)
+    return np.ascontiguousarray(tile[..., :3].astype(np.uint8, copy=False))
+
+def save_comparison_png(tile1, tile2, metrics, output_path, coords):
+    """Write the H&E, CD8 and overlay tiles side by side as a PNG using PIL
+
+    Each panel is titled like its PDF counterpart, including the tile's
+    ``coords``. This skips matplotlib entirely; the matplotlib rendering is
+    only used for the PDF report.
+    """
+    panels = [_to_rgb8(tile1), _to_rgb8(tile2), _to_rgb8(make_overlay(tile1, tile2))]
+    titles = [
+        f"H&E\n({coords[0]}, {coords[1]})",
+        f"CD8\n({coords[0]}, {coords[1]})",
+        f"Overlay\nSSIM: {metrics['ssim']:.3f}, Corr: {metrics['correlation']:.3f}",
+    ]
+    height = max(p.shape[0] for p in panels)
+    widths = [p.shape[1] for p in panels]
+    title_height = 35
+    text_height = 70
+
+    combined = Image.new('RGB', (sum(widths), title_height + height + text_height), 'white')
+    draw = ImageDraw.Draw(combined)
+    offset = 0
+    for panel, width, title in zip(panels, widths, titles):
+        draw.multiline_text((offset + 10, 5), title, fill='black')
+        combined.paste(Image.fromarray(panel), (offset, title_height))
+        offset += width
+    draw.multiline_text((10, title_height + height + 5), _metrics_text(metrics), fill='black')
+
+    combined.save(output_path, optimize=True)
+    print(f"Saved visualization to {output_path}")
+
+def visualize_tiles(tile1, tile2, he_name, cd8_name, coords, metrics, pdf):
+    """Visualize the side-by-side comparison of tiles with metrics as a page of ``pdf``
+
+    Only the PDF report uses matplotlib; per-tile PNGs are written by
+    ``save_comparison_png``.
+    """
+    plt = _import_pyplot()
+    tile1 = np.ascontiguousarray(tile1)
+    tile2 = np.ascontiguousarray(tile2)
     fig, axes = plt.subplots(1, 3, figsize=(15, 5))
 
     # Display H&E tile
@@ -107,53 +288,30 @@ def visualize_tiles(tile1, tile2, he_name, cd8_name, coords, metrics, output_pat
     axes[1].set_title(f"{cd8_name}\n({coords[0]}, {coords[1]})")
     axes[1].axis('off')
 
-    # Create overlay to show registration accuracy
-    if len(tile1.shape) == 3 and tile1.shape[2] == 3 and len(tile2.shape) == 2:
-        # If H&E is RGB and CD8 is grayscale, create a combined image
-        overlay = tile1.copy()
-        # Normalize CD8 to 0-1 range and use it as the red channel
-        cd8_norm = exposure.rescale_intensity(tile2.astype(float), out_range=(0, 1))
-        overlay[:,:,0] = (cd8_norm * 255).astype(np.uint8)  # Red channel
-    else:
-        # Simple additive blend
-        if len(tile1.shape) == 3 and len(tile2.shape) == 2:
-            # Convert grayscale to RGB
-            tile2_rgb = np.stack([tile2] * 3, axis=2)
-        elif len(tile1.shape) == 2 and len(tile2.shape) == 3:
-            tile1_rgb = np.stack([tile1] * 3, axis=2)
-            tile2_rgb = tile2
-        elif len(tile1.shape) == 2 and len(tile2.shape) == 2:
-            tile1_rgb = np.stack([tile1] * 3, axis=2)
-            tile2_rgb = np.stack([tile2] * 3, axis=2)
-        else:
-            tile1_rgb = tile1
-            tile2_rgb = tile2
-
-        # Create a simple overlay
-        overlay = (0.5 * tile1_rgb + 0.5 * tile2_rgb).astype(np.uint8)
-
-    axes[2].imshow(overlay)
+    axes[2].imshow(make_overlay(tile1, tile2))
     axes[2].set_title(f"Overlay\nSSIM: {metrics['ssim']:.3f}, Corr: {metrics['correlation']:.3f}")
     axes[2].axis('off')
 
-    plt.tight_layout()
+    fig.tight_layout()
 
     # Add metrics as text
-    metrics_text = (
-        f"Registration Metrics:\n"
-        f"SSIM: {metrics['ssim']:.4f} (higher is better, max 1.0)\n"
-        f"MSE: {metrics['mse']:.4f} (lower is better)\n"
-        f"Correlation: {metrics['correlation']:.4f} (higher is better, max 1.0)"
-    )
-    plt.figtext(0.5, 0.01, metrics_text, ha='center', fontsize=10,
+    fig.text(0.5, 0.01, _metrics_text(metrics), ha='center', fontsize=10,
                 bbox={"facecolor":"white", "alpha":0.8, "pad":5})
 
-    # Save if output path is provided
-    if output_path:
-        plt.savefig(output_path, dpi=300, bbox_inches='tight')
-        print(f"Saved visualization to {output_path}")
+    pdf.savefig(fig, bbox_inches='tight')
+    plt.close(fig)
+
+def _process_tile(job):
+    """Compute metrics for one tile pair and save its comparison PNG.
 
-    plt.close()
+    Runs in a worker process; ``job`` only carries the extracted tiles, never
+    the full slides.
+    """
+    metrics = job['metrics']
+    if metrics is None:
+        metrics = calculate_metrics(job['he_tile'], job['cd8_tile'], job['ssim_downsample'])
+    save_comparison_png(job['he_tile'], job['cd8_tile'], metrics, job['img_path'], (job['x'], job['y']))
+    return metrics
 
 def main():
     args = parse_arguments()
@@ -198,40 +356,62 @@ def main():
         (3 * width // 4, 3 * height // 4)        # Bottom-right region
     ]
 
+    # Extract tiles in the main process; only the tiles are sent to workers
+    jobs = []
+    for i, (x, y) in enumerate(coordinates):
+        print(f"\nExtracting tile {i+1} at coordinates ({x}, {y})")
+
+        he_tile = extract_tile(he_slide, x, y, tile_size)
+        cd8_tile = extract_tile(cd8_slide, x, y, tile_size)
+
+        if he_tile is None or cd8_tile is None:
+            print(f"Invalid coordinates: ({x}, {y}) with size {tile_size} for slide shapes "
+                  f"{he_slide.shape} / {cd8_slide.shape}")
+            print(f"Skipping tile {i+1} due to extraction error")
+            continue
+
+        jobs.append((i, {
+            'x': x,
+            'y': y,
+            'he_tile': he_tile,
+            'cd8_tile': cd8_tile,
+            'ssim_downsample': args.ssim_downsample,
+            'img_path': os.path.join(output_dir, f"tile_{i+1}_comparison.png"),
+            'metrics': None,
+        }))
+
+    # On the GPU all metrics are computed here in one batch; workers then only render
+    if args.device == "cuda" and jobs:
+        try:
+            tile_pairs = [(job['he_tile'], job['cd8_tile']) for _, job in jobs]
+            gpu_metrics = calculate_metrics_gpu(tile_pairs, args.ssim_downsample)
+            for (_, job), metrics in zip(jobs, gpu_metrics):
+                job['metrics'] = metrics
+        except ImportError as e:
+            print(f"GPU metrics unavailable ({e}); falling back to CPU")
+
+    plt = _import_pyplot()
+    from matplotlib.backends.backend_pdf import PdfPages
+
     # Create PDF for combined output
     pdf_path = os.path.join(output_dir, "registration_validation.pdf")
     with PdfPages(pdf_path) as pdf:
-        # Iterate through coordinates and extract tiles
+        # Metrics and per-tile PNGs are produced in parallel; results come back in order
         all_metrics = []
-        for i, (x, y) in enumerate(coordinates):
-            print(f"\nExtracting tile {i+1} at coordinates ({x}, {y})")
-
-            # Extract tiles
-            he_tile = extract_tile(he_slide, x, y, tile_size)
-            cd8_tile = extract_tile(cd8_slide, x, y, tile_size)
-
-            if he_tile is None or cd8_tile is None:
-                print(f"Skipping tile {i+1} due to extraction error")
-                continue
-
-            # Calculate metrics
-            metrics = calculate_metrics(he_tile, cd8_tile)
-            all_metrics.append(metrics)
-
-            print(f"Tile {i+1} metrics:")
-            print(f"  SSIM: {metrics['ssim']:.4f} (higher is better, max 1.0)")
-            print(f"  MSE: {metrics['mse']:.4f} (lower is better)")
-            print(f"  Correlation: {metrics['correlation']:.4f} (higher is better, max 1.0)")
-
-            # Visualize and save individual comparison
-            img_path = os.path.join(output_dir, f"tile_{i+1}_comparison.png")
-            visualize_tiles(he_tile, cd8_tile, "H&E", "CD8", (x, y), metrics, img_path)
-
-            # Also add to PDF
-            plt.figure(figsize=(15, 5))
-            visualize_tiles(he_tile, cd8_tile, "H&E", "CD8", (x, y), metrics)
-            pdf.savefig(bbox_inches='tight')
-            plt.close()
+        max_workers = max(1, min(len(jobs), os.cpu_count() or 1))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(_process_tile, [job for _, job in jobs])
+            for (i, job), metrics in zip(jobs, results):
+                all_metrics.append(metrics)
+
+                print(f"Tile {i+1} metrics:")
+                print(f"  SSIM: {metrics['ssim']:.4f} (higher is better, max 1.0)")
+                print(f"  MSE: {metrics['mse']:.4f} (lower is better)")
+                print(f"  Correlation: {metrics['correlation']:.4f} (higher is better, max 1.0)")
+
+                # The PDF page is the only matplotlib rendering of the tile
+                visualize_tiles(job['he_tile'], job['cd8_tile'], "H&E", "CD8", (job['x'], job['y']),
+                                metrics, pdf=pdf)
 
         # Calculate and display overall metrics
         if all_metrics:
@@ -1,20 +1,23 @@
 #!/usr/bin/env python3
 import os
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.gridspec import GridSpec
 from PIL import Image
 import cv2
-import glob
 import random
 import argparse
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 # Activate the correct environment if needed
 # Use conda environment as per user memory
 import sys
 
-print(f"Using Python: {sys.executable}")
-print(f"Python version: {sys.version}")
+# Below this many pairs, worker startup costs more than the comparisons themselves
+MIN_PAIRS_FOR_POOL = 16
+
+# Number of tile pairs read ahead on threads while the current pair is composed
+PREFETCH_DEPTH = 4
 
 def parse_arguments():
     """Parse command line arguments."""
@@ -26,67 +29,22 @@ def parse_arguments():
         required=True,
         help="Directory containing registration results",
     )
+    parser.add_argument(
+        "--max_pairs",
+        type=int,
+        default=5,
+        help="Maximum number of tile pairs to compare (default: 5)",
+    )
     return parser.parse_args()
 
-# Parse arguments and set base directory
-args = parse_arguments()
-BASE_DIR = args.base_dir
-
-if not os.path.exists(BASE_DIR):
-    print(f"Base directory '{BASE_DIR}' does not exist.")
-    sys.exit(1)
-
-# Define paths (will try multiple potential locations)
-potential_matrix_paths = [
-    os.path.join(BASE_DIR, "registration_matrix.npz"),
-    os.path.join(BASE_DIR, "registration_results", "registration_matrix.npz"),
-    os.path.join(BASE_DIR, "registration_results", "data", "registration_matrix.npz")
-]
-
-potential_he_tile_paths = [
-    os.path.join(BASE_DIR, "he_tiles"),
-    os.path.join(BASE_DIR, "registration_results", "matched_tiles", "he_tiles"),
-    os.path.join(BASE_DIR, "registration_results", "matched_tiles", "he"),
-    os.path.join(BASE_DIR, "matched_tiles", "he_tiles"),
-    os.path.join(BASE_DIR, "matched_tiles", "he")
-]
-
-potential_cd8_tile_paths = [
-    os.path.join(BASE_DIR, "cd8_tiles"),
-    os.path.join(BASE_DIR, "registration_results", "matched_tiles", "cd8_tiles"),
-    os.path.join(BASE_DIR, "registration_results", "matched_tiles", "cd8"),
-    os.path.join(BASE_DIR, "matched_tiles", "cd8_tiles"),
-    os.path.join(BASE_DIR, "matched_tiles", "cd8")
-]
-
-# Output directory for visualizations
-output_dir = os.path.join(BASE_DIR, "visualizations")
-os.makedirs(output_dir, exist_ok=True)
-
-# Find valid paths
-matrix_path = None
-for path in potential_matrix_paths:
-    if os.path.exists(path):
-        matrix_path = path
-        break
-
-he_tiles_dir = None
-for path in potential_he_tile_paths:
-    if os.path.exists(path):
-        he_tiles_dir = path
-        break
-
-cd8_tiles_dir = None
-for path in potential_cd8_tile_paths:
-    if os.path.exists(path):
-        cd8_tiles_dir = path
-        break
-
-print(f"Matrix path: {matrix_path}")
-print(f"HE tiles directory: {he_tiles_dir}")
-print(f"CD8 tiles directory: {cd8_tiles_dir}")
-
-def load_registration_matrix():
+def _first_existing(paths):
+    """Return the first path in ``paths`` that exists, or None."""
+    for path in paths:
+        if os.path.exists(path):
+            return path
+    return None
+
+def load_registration_matrix(matrix_path):
     """Loads the registration matrix from the NPZ file."""
     if matrix_path is None:
         print("Registration matrix file not found.")
@@ -127,6 +85,15 @@ def load_registration_matrix():
         print(f"Error loading registration matrix: {e}")
         return np.eye(3)  # Return identity matrix on error
 
+def _scan_tiles(directory):
+    """Map tile identifiers (file names without extension) to paths in one scandir pass."""
+    tiles = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith(('.png', '.jpg')) and entry.is_file():
+                tiles[os.path.splitext(entry.name)[0]] = entry.path
+    return tiles
+
 def find_matching_tile_pairs(he_dir, cd8_dir, limit=5):
     """Finds matching tile pairs from both directories."""
     if he_dir is None or cd8_dir is None:
@@ -134,38 +101,21 @@ def find_matching_tile_pairs(he_dir, cd8_dir, limit=5):
         return []
 
     try:
-        # Get lists of all image files
-        he_tiles = glob.glob(os.path.join(he_dir, "*.png")) + glob.glob(os.path.join(he_dir, "*.jpg"))
-        cd8_tiles = glob.glob(os.path.join(cd8_dir, "*.png")) + glob.glob(os.path.join(cd8_dir, "*.jpg"))
-
-        print(f"Found {len(he_tiles)} HE tiles and {len(cd8_tiles)} CD8 tiles")
+        # Index both directories by identifier (assuming common naming pattern)
+        he_ids = _scan_tiles(he_dir)
+        cd8_ids = _scan_tiles(cd8_dir)
 
-        # Extract tile identifiers to match pairs
-        matching_pairs = []
-        he_ids = {}
+        print(f"Found {len(he_ids)} HE tiles and {len(cd8_ids)} CD8 tiles")
 
-        # Extract identifiers from filenames (assuming common naming pattern)
-        for he_path in he_tiles:
-            filename = os.path.basename(he_path)
-            # Try different identifier formats
-            identifier = os.path.splitext(filename)[0]  # Without extension
-            he_ids[identifier] = he_path
-
-        # Find matching CD8 tiles
-        for cd8_path in cd8_tiles:
-            filename = os.path.basename(cd8_path)
-            identifier = os.path.splitext(filename)[0]
-
-            if identifier in he_ids:
-                matching_pairs.append((he_ids[identifier], cd8_path))
-                if len(matching_pairs) >= limit:
-                    break
+        # Find matching CD8 tiles, stopping after ``limit`` matches
+        matching_pairs = list(islice(((he_ids[identifier], cd8_path)
+                                      for identifier, cd8_path in cd8_ids.items()
+                                      if identifier in he_ids), limit))
 
         # If no matches found, try to match by index
-        if not matching_pairs and he_tiles and cd8_tiles:
+        if not matching_pairs and he_ids and cd8_ids:
             print("No matching filenames found. Matching by index...")
-            for i in range(min(limit, min(len(he_tiles), len(cd8_tiles)))):
-                matching_pairs.append((he_tiles[i], cd8_tiles[i]))
+            matching_pairs = list(islice(zip(he_ids.values(), cd8_ids.values()), limit))
 
         print(f"Found {len(matching_pairs)} matching tile pairs")
         return matching_pairs
@@ -174,41 +124,69 @@ def find_matching_tile_pairs(he_dir, cd8_dir, limit=5):
         print(f"Error finding matching tile pairs: {e}")
         return []
 
+def _read_image(path):
+    """Read an image file as BGR with cv2.imdecode (also handles non-ASCII paths)."""
+    return cv2.imdecode(np.fromfile(path, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+def _labelled(img, label, band_height=40):
+    """Return the image with a white title band containing ``label`` on top."""
+    band = np.full((band_height, img.shape[1], 3), 255, dtype=np.uint8)
+    cv2.putText(band, label, (10, band_height - 12), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 0), 2, cv2.LINE_AA)
+    return np.vstack([band, img])
+
+def _read_pair(he_path, cd8_path):
+    """Read an HE/CD8 tile pair; unreadable tiles come back as None."""
+    try:
+        return _read_image(he_path), _read_image(cd8_path)
+    except Exception as e:
+        print(f"Error reading {he_path} / {cd8_path}: {e}")
+        return None, None
+
+def _prefetch_pairs(pairs, depth=PREFETCH_DEPTH):
+    """Yield decoded (he_img, cd8_img) for each pair, reading up to ``depth`` pairs ahead.
+
+    File reads and cv2.imdecode release the GIL, so threads overlap the disk
+    I/O of upcoming pairs with composing the current one.
+    """
+    pairs = iter(pairs)
+    with ThreadPoolExecutor(max_workers=depth) as executor:
+        pending = deque(executor.submit(_read_pair, *pair) for pair in islice(pairs, depth))
+        while pending:
+            images = pending.popleft().result()
+            next_pair = next(pairs, None)
+            if next_pair is not None:
+                pending.append(executor.submit(_read_pair, *next_pair))
+            yield images
+
 def create_side_by_side_comparison(he_path, cd8_path, output_path, index):
     """Creates a side-by-side comparison of matching HE and CD8 tiles."""
-    try:
-        # Read images
-        he_img = cv2.imread(he_path)
-        cd8_img = cv2.imread(cd8_path)
+    he_img, cd8_img = _read_pair(he_path, cd8_path)
+    return save_side_by_side_comparison(he_img, cd8_img, output_path, index)
 
+def save_side_by_side_comparison(he_img, cd8_img, output_path, index):
+    """Writes a side-by-side comparison of decoded HE and CD8 tiles.
+
+    The composite is assembled with NumPy and written with cv2.imwrite,
+    bypassing matplotlib's layout and rasterization.
+    """
+    try:
         if he_img is None or cd8_img is None:
             print(f"Error loading images for comparison {index}")
             return False
 
-        # Convert to RGB for matplotlib
-        he_img_rgb = cv2.cvtColor(he_img, cv2.COLOR_BGR2RGB)
-        cd8_img_rgb = cv2.cvtColor(cd8_img, cv2.COLOR_BGR2RGB)
+        # Match heights so the tiles can be stacked horizontally
+        if cd8_img.shape[0] != he_img.shape[0]:
+            scale = he_img.shape[0] / cd8_img.shape[0]
+            cd8_img = cv2.resize(cd8_img, (max(1, round(cd8_img.shape[1] * scale)), he_img.shape[0]),
+                                 interpolation=cv2.INTER_AREA)
 
-        # Create figure with side-by-side comparison
-        fig = plt.figure(figsize=(12, 6))
-        gs = GridSpec(1, 2, figure=fig)
+        composite = np.hstack([_labelled(he_img, 'H&E Tile'), _labelled(cd8_img, 'CD8 Tile')])
+        composite = _labelled(composite, f'Tile Pair Comparison {index}')
 
-        ax1 = fig.add_subplot(gs[0, 0])
-        ax1.imshow(he_img_rgb)
-        ax1.set_title('H&E Tile')
-        ax1.axis('off')
-
-        ax2 = fig.add_subplot(gs[0, 1])
-        ax2.imshow(cd8_img_rgb)
-        ax2.set_title('CD8 Tile')
-        ax2.axis('off')
-
-        plt.suptitle(f'Tile Pair Comparison {index}')
-        plt.tight_layout()
-
-        # Save figure
-        plt.savefig(output_path, dpi=150, bbox_inches='tight')
-        plt.close(fig)
+        # Save image (OpenCV expects BGR, which is how the tiles were decoded)
+        if not cv2.imwrite(output_path, composite):
+            print(f"Error writing comparison {index} to {output_path}")
+            return False
 
         print(f"Saved comparison {index} to {output_path}")
         return True
@@ -218,19 +196,83 @@ def create_side_by_side_comparison(he_path, cd8_path, output_path, index):
         return False
 
 def main():
-    """Main function to execute all visualization tasks."""
+    """Main function to execute all visualization tasks.
+
+    All setup happens here rather than at import time, so that worker
+    processes started with spawn/forkserver do not repeat it.
+    """
+    print(f"Using Python: {sys.executable}")
+    print(f"Python version: {sys.version}")
+
+    # Parse arguments and set base directory
+    args = parse_arguments()
+    base_dir = args.base_dir
+
+    if not os.path.exists(base_dir):
+        print(f"Base directory '{base_dir}' does not exist.")
+        return 1
+
+    # Define paths (will try multiple potential locations)
+    potential_matrix_paths = [
+        os.path.join(base_dir, "registration_matrix.npz"),
+        os.path.join(base_dir, "registration_results", "registration_matrix.npz"),
+        os.path.join(base_dir, "registration_results", "data", "registration_matrix.npz")
+    ]
+
+    potential_he_tile_paths = [
+        os.path.join(base_dir, "he_tiles"),
+        os.path.join(base_dir, "registration_results", "matched_tiles", "he_tiles"),
+        os.path.join(base_dir, "registration_results", "matched_tiles", "he"),
+        os.path.join(base_dir, "matched_tiles", "he_tiles"),
+        os.path.join(base_dir, "matched_tiles", "he")
+    ]
+
+    potential_cd8_tile_paths = [
+        os.path.join(base_dir, "cd8_tiles"),
+        os.path.join(base_dir, "registration_results", "matched_tiles", "cd8_tiles"),
+        os.path.join(base_dir, "registration_results", "matched_tiles", "cd8"),
+        os.path.join(base_dir, "matched_tiles", "cd8_tiles"),
+        os.path.join(base_dir, "matched_tiles", "cd8")
+    ]
+
+    # Output directory for visualizations
+    output_dir = os.path.join(base_dir, "visualizations")
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Find valid paths
+    matrix_path = _first_existing(potential_matrix_paths)
+    he_tiles_dir = _first_existing(potential_he_tile_paths)
+    cd8_tiles_dir = _first_existing(potential_cd8_tile_paths)
+
+    print(f"Matrix path: {matrix_path}")
+    print(f"HE tiles directory: {he_tiles_dir}")
+    print(f"CD8 tiles directory: {cd8_tiles_dir}")
+
     # Load and display registration matrix
-    matrix = load_registration_matrix()
+    matrix = load_registration_matrix(matrix_path)
 
     # Find matching tile pairs
-    matching_pairs = find_matching_tile_pairs(he_tiles_dir, cd8_tiles_dir)
+    matching_pairs = find_matching_tile_pairs(he_tiles_dir, cd8_tiles_dir, limit=args.max_pairs)
 
-    # Create side-by-side comparisons
+    # Create side-by-side comparisons; each pair is independent, so large
+    # batches are spread over all cores
     successful_comparisons = 0
-    for i, (he_path, cd8_path) in enumerate(matching_pairs):
-        output_path = os.path.join(output_dir, f"tile_comparison_{i+1}.png")
-        if create_side_by_side_comparison(he_path, cd8_path, output_path, i+1):
-            successful_comparisons += 1
+    if matching_pairs:
+        he_paths, cd8_paths = zip(*matching_pairs)
+        output_paths = [os.path.join(output_dir, f"tile_comparison_{i+1}.png")
+                        for i in range(len(matching_pairs))]
+        indices = range(1, len(matching_pairs) + 1)
+        max_workers = max(1, min(len(matching_pairs), (os.cpu_count() or 2) - 1))
+        if len(matching_pairs) < MIN_PAIRS_FOR_POOL or max_workers == 1:
+            # Upcoming tiles are read on threads while the current pair is written
+            for (he_img, cd8_img), output_path, index in zip(_prefetch_pairs(matching_pairs),
+                                                             output_paths, indices):
+                if save_side_by_side_comparison(he_img, cd8_img, output_path, index):
+                    successful_comparisons += 1
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = executor.map(create_side_by_side_comparison, he_paths, cd8_paths, output_paths, indices)
+                successful_comparisons = sum(1 for ok in results if ok)
 
     # Print summary
     print("\nSummary:")
@@ -242,7 +284,8 @@ def main():
     print(f"\nCreated {successful_comparisons} side-by-side comparisons")
     print(f"Output directory: {output_dir}")
     print("=" * 50)
+    return 0
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
 
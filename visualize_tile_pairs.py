@@ -11,12 +11,20 @@ import os
 import sys
 import argparse
 import numpy as np
+import cv2
 import pandas as pd
+import zarr
 import matplotlib.pyplot as plt
 from tifffile import TiffFile
-from skimage.metrics import structural_similarity as ssim
+from ssim_numba import structural_similarity as ssim
 from skimage.transform import resize
 
+# Columns read from the tile similarity metrics CSV
+METRIC_COLUMNS = ['combined_score', 'ssim', 'ncc']
+
+# Luma weights used for RGB to grayscale conversion of non-uint8 tiles
+_GRAY_W = np.array([0.2989, 0.5870, 0.1140], dtype=np.float32)
+
 def parse_arguments():
     """Parse command-line arguments."""
     parser = argparse.ArgumentParser(description='Visualize tile pairs from registered slides')
@@ -29,24 +37,49 @@ def parse_arguments():
     parser.add_argument('--num_samples', type=int, default=5, help='Number of tile pairs to sample (default: 5)')
     return parser.parse_args()
 
+def load_metrics_csv(csv_path):
+    """Load only the metric columns used here, with pyarrow's parser if available."""
+    kwargs = dict(usecols=METRIC_COLUMNS, dtype={c: np.float32 for c in METRIC_COLUMNS})
+    try:
+        import pyarrow  # noqa: F401
+        return pd.read_csv(csv_path, engine='pyarrow', **kwargs)
+    except ImportError:
+        return pd.read_csv(csv_path, engine='c', memory_map=True, **kwargs)
+
 def load_and_downsample_slide(slide_path, downsample_factor):
-    """Load a slide and downsample it to reduce memory requirements."""
+    """Load a slide and downsample it to reduce memory requirements.
+
+    The coarsest pyramid level whose scale divides ``downsample_factor`` is
+    read, and only the remaining factor is applied by striding. Without a
+    suitable level the full-resolution page is strided through a zarr store,
+    so the whole page is never held in memory at once.
+    """
     print(f"Loading and downsampling {os.path.basename(slide_path)} (factor: {downsample_factor})...")
 
     with TiffFile(slide_path) as tif:
         # Get the first page
         page = tif.pages[0]
         is_multi_channel = len(page.shape) > 2
-        img = page.asarray()
 
-        print(f"Image shape: {img.shape}")
+        print(f"Image shape: {page.shape}")
 
-        # Downsample using simple slicing for speed
-        if downsample_factor > 1:
-            img = img[::downsample_factor, ::downsample_factor]
-            if len(img.shape) > 2:
-                img = img[:, :, :]  # Keep all channels
+        # Pick the pyramid level closest to the target scale
+        level_page, level_factor = page, 1
+        for level in tif.series[0].levels[1:]:
+            candidate = level.pages[0]
+            factor = round(page.shape[0] / candidate.shape[0])
+            if factor > level_factor and downsample_factor % factor == 0:
+                level_page, level_factor = candidate, factor
 
+        # Downsample the remainder using simple slicing for speed
+        step = max(1, downsample_factor // level_factor)
+        if step > 1:
+            img = zarr.open(level_page.aszarr(), mode='r')[::step, ::step]
+        else:
+            img = level_page.asarray()
+
+        if level_factor > 1:
+            print(f"Using pyramid level downsampled {level_factor}x")
         print(f"Downsampled shape: {img.shape}")
 
     return img, is_multi_channel
@@ -63,57 +96,48 @@ def extract_tile(image, row, col, tile_size):
     else:
         return image[row_start:row_start+tile_size, col_start:col_start+tile_size]
 
-def normalized_cross_correlation(image1, image2):
-    """Calculate normalized cross-correlation between two images."""
-    if len(image1.shape) > 2:  # Convert RGB to grayscale
-        image1_gray = np.dot(image1[...,:3], [0.2989, 0.5870, 0.1140])
-    else:
-        image1_gray = image1
-
-    if len(image2.shape) > 2:  # Convert RGB to grayscale
-        image2_gray = np.dot(image2[...,:3], [0.2989, 0.5870, 0.1140])
-    else:
-        image2_gray = image2
-
-    # Normalize images
-    image1_norm = (image1_gray - np.mean(image1_gray)) / (np.std(image1_gray) + 1e-8)
-    image2_norm = (image2_gray - np.mean(image2_gray)) / (np.std(image2_gray) + 1e-8)
+def to_gray(img):
+    """Convert an RGB image to grayscale; single-channel images are returned as is."""
+    if img.ndim == 2:
+        return img
+    if img.shape[2] == 1:
+        return img.squeeze(-1)
+    if img.dtype == np.uint8 and img.shape[2] == 3:
+        return cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    return np.einsum('hwc,c->hw', img[..., :3].astype(np.float32, copy=False), _GRAY_W)
 
-    return np.mean(image1_norm * image2_norm)
+def to_uint8(gray):
+    """Min-max scale a grayscale image to the full uint8 range, whatever its dtype."""
+    return cv2.normalize(gray, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
 
 def calculate_similarity(cd8_tile, he_tile):
     """Calculate similarity metrics between two tiles."""
     # Convert to grayscale if needed
-    if len(cd8_tile.shape) > 2:
-        cd8_gray = np.dot(cd8_tile[...,:3], [0.2989, 0.5870, 0.1140])
-    else:
-        cd8_gray = cd8_tile
-
-    if len(he_tile.shape) > 2:
-        he_gray = np.dot(he_tile[...,:3], [0.2989, 0.5870, 0.1140])
-    else:
-        he_gray = he_tile
+    cd8_gray = to_gray(cd8_tile)
+    he_gray = to_gray(he_tile)
 
-    # Normalize images
-    cd8_norm = (cd8_gray - np.mean(cd8_gray)) / (np.std(cd8_gray) + 1e-8)
-    he_norm = (he_gray - np.mean(he_gray)) / (np.std(he_gray) + 1e-8)
-
-    # Calculate metrics
+    # SSIM on 8-bit tiles with a fixed data range
     try:
-        ssim_score = ssim(cd8_norm, he_norm, data_range=np.max(cd8_norm) - np.min(cd8_norm))
+        ssim_score = ssim(to_uint8(cd8_gray), to_uint8(he_gray), data_range=255)
     except:
         ssim_score = 0
 
-    try:
-        ncc_score = normalized_cross_correlation(cd8_norm, he_norm)
-    except:
-        ncc_score = 0
+    # Normalize images (float32 is plenty for the correlation metrics)
+    cd8_gray = cd8_gray.astype(np.float32, copy=False)
+    he_gray = he_gray.astype(np.float32, copy=False)
+    cd8_norm = (cd8_gray - cd8_gray.mean()) / (cd8_gray.std() + 1e-8)
+    he_norm = (he_gray - he_gray.mean()) / (he_gray.std() + 1e-8)
+
+    # Both arrays are zero-mean and unit-variance, so NCC is their mean product
+    # and Pearson the cosine similarity; one dot product serves both
+    cd8_flat = cd8_norm.ravel()
+    he_flat = he_norm.ravel()
+    dot = float(cd8_flat @ he_flat)
+    ncc_score = dot / cd8_flat.size
 
     # Try a simple Pearson correlation coefficient as well
     try:
-        cd8_flat = cd8_norm.flatten()
-        he_flat = he_norm.flatten()
-        pearson = np.corrcoef(cd8_flat, he_flat)[0, 1]
+        pearson = dot / np.sqrt(float(cd8_flat @ cd8_flat) * float(he_flat @ he_flat))
     except:
         pearson = 0
 
@@ -123,91 +147,98 @@ def calculate_similarity(cd8_tile, he_tile):
         'pearson': pearson
     }
 
+def visualize_sample(cd8_img, he_img, output_dir, tile_size,
+                     idx, row, col, combined_score, csv_ssim, csv_ncc):
+    """Render one CD8/H&E tile pair with its CSV and live similarity metrics."""
+    # Extract tiles
+    cd8_tile = extract_tile(cd8_img, row, col, tile_size)
+    he_tile = extract_tile(he_img, row, col, tile_size)
+
+    # Calculate similarity metrics live
+    live_metrics = calculate_similarity(cd8_tile, he_tile)
+
+    # Create visualization
+    fig, axs = plt.subplots(1, 3, figsize=(15, 6))
+
+    # Display CD8 tile
+    if len(cd8_tile.shape) > 2 and cd8_tile.shape[2] == 3:
+        axs[0].imshow(cd8_tile)
+    else:
+        axs[0].imshow(cd8_tile, cmap='gray')
+    axs[0].set_title(f"CD8 Tile (Row {row}, Col {col})")
+    axs[0].axis('off')
+
+    # Display H&E tile
+    if len(he_tile.shape) > 2 and he_tile.shape[2] == 3:
+        axs[1].imshow(he_tile)
+    else:
+        axs[1].imshow(he_tile, cmap='gray')
+    axs[1].set_title(f"H&E Tile (Row {row}, Col {col})")
+    axs[1].axis('off')
+
+    # Display overlay or difference
+    if len(cd8_tile.shape) > 2 or len(he_tile.shape) > 2:
+        # For RGB images, just show them side by side
+        axs[2].text(0.5, 0.5, "RGB overlay not shown", horizontalalignment='center', verticalalignment='center')
+        axs[2].axis('off')
+    else:
+        # For grayscale, show difference
+        # cv2.absdiff saturates correctly for unsigned tiles in one SIMD pass
+        if cd8_tile.dtype == he_tile.dtype:
+            diff = cv2.absdiff(cd8_tile, he_tile)
+        else:
+            diff = np.abs(cd8_tile.astype(np.float32) - he_tile.astype(np.float32))
+        im = axs[2].imshow(diff, cmap='hot')
+        axs[2].set_title("Absolute Difference")
+        axs[2].axis('off')
+        plt.colorbar(im, ax=axs[2], fraction=0.046, pad=0.04)
+
+    # Add metrics as text
+    metrics_text = (
+        f"Similarity Metrics:\n"
+        f"SSIM: {csv_ssim:.4f} (CSV) / {live_metrics['ssim']:.4f} (Live)\n"
+        f"NCC: {csv_ncc:.4f} (CSV) / {live_metrics['ncc']:.4f} (Live)\n"
+        f"Pearson: {live_metrics['pearson']:.4f} (Live)\n"
+        f"Combined: {combined_score:.4f} (CSV)"
+    )
+    fig.text(0.5, 0.01, metrics_text, ha='center', fontsize=12, bbox=dict(facecolor='white', alpha=0.8))
+
+    # Save figure
+    output_path = os.path.join(output_dir, f"tile_comparison_idx{idx}_row{row}_col{col}.png")
+    plt.tight_layout()
+    plt.savefig(output_path, dpi=200)
+    plt.close()
+    print(f"Saved comparison: {output_path}")
+
 def visualize_tile_pairs(cd8_img, he_img, metrics_df, output_dir, tile_size, num_samples):
     """Visualize pairs of tiles from the CD8 and H&E slides."""
     # Sort by combined score
     metrics_df['abs_combined_score'] = np.abs(metrics_df['combined_score'])
 
     # Get tile indices at different quality levels
-    samples = []
     if len(metrics_df) >= num_samples:
-        # Get best, worst, and middle tiles
-        best_idx = metrics_df.nlargest(max(1, num_samples // 3), 'combined_score').index.tolist()
-        worst_idx = metrics_df.nsmallest(max(1, num_samples // 3), 'combined_score').index.tolist()
-        middle_idx = metrics_df.iloc[len(metrics_df)//2:len(metrics_df)//2 + max(1, num_samples - len(best_idx) - len(worst_idx))].index.tolist()
-        samples = best_idx + worst_idx + middle_idx
+        # Get best, worst, and middle tiles by position; argpartition is O(N) vs a full sort
+        scores = metrics_df['combined_score'].to_numpy()
+        k = max(1, num_samples // 3)
+        best_pos = np.argpartition(-scores, k - 1)[:k]
+        worst_pos = np.argpartition(scores, k - 1)[:k]
+        mid = len(scores) // 2
+        middle_pos = np.arange(mid, min(len(scores), mid + max(1, num_samples - 2 * k)))
+        positions = np.concatenate([best_pos, worst_pos, middle_pos])
+        sel = metrics_df.index.to_numpy()[positions]
     else:
-        samples = metrics_df.index.tolist()
-
-    # Extract row and column for each sample
-    sample_info = []
-    for idx in samples:
-        sample_info.append({
-            'index': idx,
-            'row': idx // (cd8_img.shape[1] // tile_size),
-            'col': idx % (cd8_img.shape[1] // tile_size),
-            'combined_score': metrics_df.loc[idx, 'combined_score'],
-            'ssim': metrics_df.loc[idx, 'ssim'],
-            'ncc': metrics_df.loc[idx, 'ncc']
-        })
+        sel = metrics_df.index.to_numpy()
 
-    # Visualize each sample
-    for sample in sample_info:
-        # Extract tiles
-        cd8_tile = extract_tile(cd8_img, sample['row'], sample['col'], tile_size)
-        he_tile = extract_tile(he_img, sample['row'], sample['col'], tile_size)
-
-        # Calculate similarity metrics live
-        live_metrics = calculate_similarity(cd8_tile, he_tile)
-
-        # Create visualization
-        fig, axs = plt.subplots(1, 3, figsize=(15, 6))
-
-        # Display CD8 tile
-        if len(cd8_tile.shape) > 2 and cd8_tile.shape[2] == 3:
-            axs[0].imshow(cd8_tile)
-        else:
-            axs[0].imshow(cd8_tile, cmap='gray')
-        axs[0].set_title(f"CD8 Tile (Row {sample['row']}, Col {sample['col']})")
-        axs[0].axis('off')
+    # Extract row, column and CSV metrics for all samples at once
+    cols_per_row = cd8_img.shape[1] // tile_size
+    rows = sel // cols_per_row
+    cols = sel % cols_per_row
+    vals = metrics_df.loc[sel, METRIC_COLUMNS].to_numpy()
 
-        # Display H&E tile
-        if len(he_tile.shape) > 2 and he_tile.shape[2] == 3:
-            axs[1].imshow(he_tile)
-        else:
-            axs[1].imshow(he_tile, cmap='gray')
-        axs[1].set_title(f"H&E Tile (Row {sample['row']}, Col {sample['col']})")
-        axs[1].axis('off')
-
-        # Display overlay or difference
-        if len(cd8_tile.shape) > 2 or len(he_tile.shape) > 2:
-            # For RGB images, just show them side by side
-            axs[2].text(0.5, 0.5, "RGB overlay not shown", horizontalalignment='center', verticalalignment='center')
-            axs[2].axis('off')
-        else:
-            # For grayscale, show difference
-            diff = np.abs(cd8_tile - he_tile)
-            im = axs[2].imshow(diff, cmap='hot')
-            axs[2].set_title("Absolute Difference")
-            axs[2].axis('off')
-            plt.colorbar(im, ax=axs[2], fraction=0.046, pad=0.04)
-
-        # Add metrics as text
-        metrics_text = (
-            f"Similarity Metrics:\n"
-            f"SSIM: {sample['ssim']:.4f} (CSV) / {live_metrics['ssim']:.4f} (Live)\n"
-            f"NCC: {sample['ncc']:.4f} (CSV) / {live_metrics['ncc']:.4f} (Live)\n"
-            f"Pearson: {live_metrics['pearson']:.4f} (Live)\n"
-            f"Combined: {sample['combined_score']:.4f} (CSV)"
-        )
-        fig.text(0.5, 0.01, metrics_text, ha='center', fontsize=12, bbox=dict(facecolor='white', alpha=0.8))
-
-        # Save figure
-        output_path = os.path.join(output_dir, f"tile_comparison_idx{sample['index']}_row{sample['row']}_col{sample['col']}.png")
-        plt.tight_layout()
-        plt.savefig(output_path, dpi=200)
-        plt.close()
-        print(f"Saved comparison: {output_path}")
+    # Visualize each sample
+    for idx, row, col, (combined_score, csv_ssim, csv_ncc) in zip(sel, rows, cols, vals):
+        visualize_sample(cd8_img, he_img, output_dir, tile_size,
+                         idx, row, col, combined_score, csv_ssim, csv_ncc)
 
 def main():
     """Main function."""
@@ -218,7 +249,7 @@ def main():
 
     try:
         # Load metrics CSV
-        metrics_df = pd.read_csv(args.metrics_csv)
+        metrics_df = load_metrics_csv(args.metrics_csv)
         print(f"Loaded {len(metrics_df)} tile metrics from {args.metrics_csv}")
 
         # Load and downsample slides
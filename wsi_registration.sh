@@ -61,10 +61,9 @@ if [ "$1" = "--pair-index" ]; then
     fi
 
     SLIDE_INFO=$(python - <<EOF
-from slide_utils import load_wasabi_tree, get_slide_pairs
+from slide_utils import load_slide_pairs
 import sys
-tree = load_wasabi_tree("$JSON_FILE")
-pairs = get_slide_pairs(tree)
+pairs = load_slide_pairs("$JSON_FILE")
 idx = int("$PAIR_INDEX")
 if idx < 1 or idx > len(pairs):
     raise SystemExit(f"pair_index {idx} out of range")